@@ -31,9 +31,15 @@ Last change:
 """
 
 import os
+import json
+import queue
+import posixpath
 import argparse
 import logging
-from util import FTPGetter
+import threading
+from ftplib import all_errors
+from concurrent.futures import ThreadPoolExecutor
+from util import FTPGetter, CONNECTION_ERRORS
 from datetime import datetime
 
 def parse_input():
@@ -45,16 +51,54 @@ def parse_input():
              formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-d','--debug', action='store_true', required=False,
                         help='Print out debug information, default is False')
+    parser.add_argument('-w','--workers', type=int, default=4, required=False,
+                        help='Number of parallel ftp connections, default is 4')
+    parser.add_argument('-t','--tls', action='store_true', required=False,
+                        help='Connect using FTP over TLS, default is False')
+    parser.add_argument('-s','--skip', action='store_true', required=False,
+                        help='Skip directories not modified since last run '
+                             + 'and without subdirectories,\n'
+                             + 'files replaced in place are missed, '
+                             + 'default is False')
     return vars(parser.parse_args())
 
+
+def read_mtimes(fname):
+    """Read remote directories modified times saved by last run"""
+
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, "r") as f:
+        return json.load(f)
+
+
+def write_mtimes(fname, mtimes):
+    """Save remote directories modified times for next run"""
+
+    with open(f"{fname}.part", "w") as f:
+        json.dump(mtimes, f, indent=1, sort_keys=True)
+    os.replace(f"{fname}.part", fname)
+
+
 def main():
     """Uses FTPGetter instance to start ftp session and download data
 
     If files already exists localy, to decide if updates are needed
     the variable 'check' (default is "") can be set to:
-     - md5sum  it will compare md5sum for local and remote files
+     - md5sum  it will compare checksums (sha256) for local and remote files
      - mdate it will use modified time
      NB md5sums is slow as it transfers the files first anyway
+    Remote directories are listed first walking the tree with one
+    connection, then files are downloaded in parallel by --workers
+    threads, each one with its own ftp connection. A lost connection is
+    opened again, files left when no connection can be opened are
+    processed with the first one.
+    Directories modified times are saved at the end of each run, with
+    --skip directories not modified since are not checked. A directory
+    modified time changes only when files are added, removed or renamed
+    so this misses files replaced in place and it isn't the default.
+    Changes in subdirectories don't change it either, so directories
+    which had subdirectories are never skipped.
     """
 
     # Initialise getter instance
@@ -67,28 +111,158 @@ def main():
     user = os.getenv("USER")
     root_dir = os.getenv("AUSREFDIR", "/g/data/ia39/aus-ref-clim-data-nci")
     flog = f"{root_dir}/frogs/code/update_log.txt"
-    getter = FTPGetter("ftp.climserv.ipsl.polytechnique.fr",
-                        check='mdate', extension=".nc", flog=flog, level=level)
+    fmtimes = f"{root_dir}/frogs/code/dir_mtimes.json"
+    ftpHost = "ftp.climserv.ipsl.polytechnique.fr"
+    getter = FTPGetter(ftpHost, check='mdate', extension=".nc", flog=flog,
+                       level=level, tls=inputs["tls"])
     # connect to log
     data_log = getter.logger
     data_log.info(f"Updated on {today} by {user}")
     datasetName = "1DD_V1"
     localDir = f"{root_dir}/frogs/data/"
     remoteDir = "FROGs/"
-    datasetList = []
-    data_log.debug(f"Processing dataset... {datasetName}")
-    getter.ftp.cwd(remoteDir + datasetName)   # go to dataset dir
-    os.chdir(localDir + datasetName)   # go to dataset dir
-    getter.ftp.retrlines("LIST", datasetList.append)
-    for ds in datasetList[2:]:
-        fileList = getter.doDirectory(ds,True)
-        baseDir = os.getcwd()
-        for f in fileList:
-            getter.handleFile(baseDir, f)
-        getter.ftp.cwd("../")  # get out of ftp dataset dir
-        os.chdir("../")     #get out of local dataset dir
+    data_log.debug("Processing dataset... %s", datasetName)
+    # First walk the remote directories with one connection
+    # and collect the files to process with their local directory
+    # if requested skip directories which weren't modified since last run
+    # and had no subdirectories
+    mtimes = read_mtimes(fmtimes)
+    newMtimes = {}
+    seenDirs = set()
+
+    def skip(ftpDir, facts):
+        seenDirs.add(ftpDir)
+        modify = facts.get("modify")
+        if modify is None:
+            return False
+        last = mtimes.get(ftpDir, {})
+        if (inputs["skip"] and last.get("subdirs") is False
+                and modify <= last["modify"]):
+            return True
+        newMtimes[ftpDir] = modify
+        return False
+
+    workList = []
+    ftpRoot = posixpath.join(getter.ftp.pwd(), remoteDir + datasetName)
+    localRoot = localDir + datasetName
+    for ftpDir, f, facts in getter.walk(ftpRoot, skip=skip):
+        # only files inside the dataset directories are downloaded
+        if ftpDir == ftpRoot:
+            continue
+        baseDir = os.path.normpath(os.path.join(localRoot,
+                                   posixpath.relpath(ftpDir, ftpRoot)))
+        workList.append((ftpDir, f, facts, baseDir))
+    for baseDir in set(w[3] for w in workList):
+        os.makedirs(baseDir, exist_ok=True)
+
+    # Then process files in parallel, each thread opens its own connection
+    # start from largest files so these don't delay the end of the run
+    workList.sort(key=lambda x: int(x[2].get("size", 0)), reverse=True)
+    workQueue = queue.Queue()
+    for item in workList:
+        # number of connections lost while processing the file
+        workQueue.put((item, 0))
+    lock = threading.Lock()
+    workers = []
+
+    def process(ftpGetter, item, reraise=False):
+        """Process one file, return its directory if there were errors
+
+        If reraise is True connection errors are raised, so the file
+        can be retried with a new connection
+        """
+
+        ftpDir, filename, facts, baseDir = item
+        nerrors = len(ftpGetter.errorFiles)
+        try:
+            ftpGetter.handleFile(ftpDir, baseDir, filename, facts)
+        except Exception as error:
+            if reraise and isinstance(error, CONNECTION_ERRORS):
+                raise
+            remoteFile = posixpath.join(ftpDir, filename)
+            ftpGetter.errorFiles.append(
+                f"{remoteFile} could not be processed: {error}")
+            data_log.error(error)
+        if len(ftpGetter.errorFiles) > nerrors:
+            return ftpDir
+
+    def connect():
+        """Open a new connection, return None if it fails"""
+
+        try:
+            ftpGetter = FTPGetter(ftpHost, check='mdate', extension=".nc",
+                                  logger=data_log, tls=inputs["tls"])
+        except all_errors as error:
+            data_log.warning("Could not open ftp connection: %s", error)
+            return None
+        with lock:
+            workers.append(ftpGetter)
+        return ftpGetter
+
+    def work():
+        """Process files from the queue until it is empty
+
+        If the connection is lost it is closed and the file put back
+        in the queue to be retried once. If a connection can't be
+        opened the thread stops, leaving its file to the other threads
+        """
+
+        failed = set()
+        ftpGetter = None
+        while True:
+            try:
+                item, lost = workQueue.get_nowait()
+            except queue.Empty:
+                break
+            if ftpGetter is None:
+                ftpGetter = connect()
+                if ftpGetter is None:
+                    workQueue.put((item, lost))
+                    break
+            try:
+                failed.add(process(ftpGetter, item, reraise=lost == 0))
+            except CONNECTION_ERRORS as error:
+                data_log.warning("Lost ftp connection: %s", error)
+                ftpGetter.close()
+                ftpGetter = None
+                workQueue.put((item, lost + 1))
+        if ftpGetter is not None:
+            ftpGetter.close()
+        return failed
+
+    # keep the first connection alive while it waits for the workers
+    getter.start_heartbeat()
+    try:
+        with ThreadPoolExecutor(max_workers=inputs["workers"]) as executor:
+            futures = [executor.submit(work)
+                       for i in range(inputs["workers"])]
+            failedDirs = set().union(*(f.result() for f in futures))
+    finally:
+        getter.stop_heartbeat()
+        # merge results from each connection
+        for w in workers:
+            getter.updatedFiles.extend(w.updatedFiles)
+            getter.newFiles.extend(w.newFiles)
+            getter.errorFiles.extend(w.errorFiles)
+
+    # if no connection could be kept open for some files,
+    # process them using the first connection only
+    if not workQueue.empty():
+        data_log.info("Processing %s files with one connection",
+                      workQueue.qsize())
+        while not workQueue.empty():
+            item, lost = workQueue.get_nowait()
+            failedDirs.add(process(getter, item))
 
     getter.print_summary()
+    # save modified times only for directories without errors
+    # including their subdirectories
+    for d, modify in newMtimes.items():
+        if not any(f is not None and (f == d or f.startswith(d + "/"))
+                   for f in failedDirs):
+            subdirs = any(s.startswith(d + "/") for s in seenDirs)
+            mtimes[d] = {"modify": modify, "subdirs": subdirs}
+    write_mtimes(fmtimes, mtimes)
     getter.close()
     logging.shutdown()
 
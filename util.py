@@ -27,16 +27,31 @@ Modified version of a code originally from Pauline Mak
  """
 
 import os
+import posixpath
+import grp
+import stat
+import ssl
+import socket
 import hashlib
 import logging
-from ftplib import FTP, all_errors
+import logging.handlers
+import queue
+import atexit
+import threading
+from ftplib import FTP, FTP_TLS, all_errors, error_perm, error_temp
 from datetime import datetime
-from time import gmtime, strptime
+from time import gmtime
+
+# size of blocks used to read and transfer files
+BLOCKSIZE = 1 << 20
+# errors after which the connection might not be usable anymore
+CONNECTION_ERRORS = (OSError, EOFError, error_temp)
 
 
 class FTPGetter():
     def __init__(self, ftpHost, check="", extension=".nc", user=None,
-                 pwd=None, flog="download.log", level="debug"):
+                 pwd=None, flog="download.log", level="debug", logger=None,
+                 digest="sha256", group="ia39", tls=False):
         """Initiate instance of FTPGetter
 
         Parameters
@@ -58,29 +73,74 @@ class FTPGetter():
             Name of log file (default="download.log")
         level: str, optional
             Logging level (default="debug")
+        logger: logging.Logger, optional
+            Existing logger to reuse, i.e. when opening more than one
+            connection, if None a new one is set up (default is None)
+        digest: str, optional
+            Hash algorithm used when check is md5sum, any name accepted
+            by hashlib.new or blake2b. sha256 is faster than md5 on CPUs
+            with SHA extensions (default="sha256")
+        group: str, optional
+            Group owning downloaded files (default="ia39")
+        tls: bool, optional
+            If True connect using FTP over TLS, data connections are
+            protected too (default=False)
         """
         self.updatedFiles = []
         self.newFiles = []
         self.errorFiles = []
         self.check = check
+        # method used to compare local and remote files, None for no check
+        self._check_fn = {'md5sum': self.check_md5sum,
+                          'mdate': self.check_mdt}.get(check)
         self.extension = extension
-        self.ftp = FTP(ftpHost)
+        # fail here on an invalid algorithm name rather than for each file
+        new_hash(digest)
+        self.digest = digest
+        # group id is looked up once here rather than for each file
+        try:
+            self._gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            self._gid = None
+        # None until checked, then True if server supports MLSD
+        self._mlsd = None
+        self._heartbeat = None
+        self._listener = None
+        if tls:
+            self.ftp = FTP_TLS(ftpHost,
+                               context=ssl.create_default_context())
+        else:
+            self.ftp = FTP(ftpHost)
+        self.set_keepalive()
         if user:
             if pwd is None:
                 raise Exception("Password needed to login as user")
             self.ftp.login(user, pwd)
         else:
             self.ftp.login()
-        # set up logger
-        self.logger = self.set_log('log', flog, level=level)
+        if tls:
+            self.ftp.prot_p()
+        # set up logger, unless one is passed by the caller
+        if logger is None:
+            logger = self.set_log('log', flog, level=level)
+        self.logger = logger
 
-        self.logger.debug(f"Check: {check}")
-        self.logger.debug(f"Extension: {extension}")
+        self.logger.debug("Check: %s", check)
+        self.logger.debug("Digest: %s", digest)
+        self.logger.debug("Extension: %s", extension)
+        if self._gid is None:
+            self.logger.debug("Group %s not found, files group unchanged",
+                              group)
 
 
     def set_log(self, name, fname, level):
         """Set up logging with a file handler
 
+        Records are passed through a queue to the console and file
+        handlers, which run in a listener thread, so threads using the
+        logger don't wait on the handlers. The listener is stopped by
+        close() or at exit
+
         Parameters
         ----------
         name: str
@@ -109,160 +169,362 @@ class FTPGetter():
         console_handler = logging.StreamHandler()
         console_handler.setLevel(log_level)
         console_handler.setFormatter(minimal)
-        logger.addHandler(console_handler)
         # add a handler for the log file, this is set to INFO level
+        # the file is opened here so a wrong path fails straight away
         file_handler = logging.FileHandler(fname)
         file_handler.setLevel(logging.INFO)
         file_handler.setFormatter(minimal)
-        logger.addHandler(file_handler)
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self._listener = logging.handlers.QueueListener(log_queue,
+            console_handler, file_handler, respect_handler_level=True)
+        # handlers are only referenced here, so they are closed by stop_log
+        self._handlers = [console_handler, file_handler]
+        self._listener.start()
+        atexit.register(self.stop_log)
         # return the logger object
         logger.propagate = False
         return logger
  
 
-    def doDirectory(self, dirLine, makedir):
-        """Process a directory return list of files and subdirs"""
-
-        lineList = []
-        if(dirLine[0] == 'd'):
-            dirName = dirLine[(dirLine.rindex(" ") + 1):]
-            self.logger.debug(f"do Directory dirName: {dirName}")
-            if makedir:
-               if(not os.path.exists(dirName)):
-                  os.mkdir(dirName)
-               os.chdir(dirName)  # go to "dataset" dir
-            self.ftp.cwd(dirName)
-            self.logger.debug(f"ftp: {self.ftp.pwd()}")
-            self.ftp.retrlines("LIST", lineList.append)
-        self.logger.debug(f"Dir listing: {lineList}")
-        self.logger.debug(f"do Directory dirLine: {dirLine}")
-        return lineList 
-
-
-    def handleFile(self, baseDir, fileLine):
-        """Handle files, call doFile if extension correspond"""
-
-        if fileLine[0]== '-'  :
-            try:    
-                line = fileLine[(fileLine.rindex(" ") + 1):]
-                filename = line.split(" ")[-1]
-                idx = len(self.extension)
-                if filename[-idx:] == self.extension:
-                   self.doFile(baseDir, filename)    
-            except ValueError as error:
-                self.logger.debug("Handle file: {error}")
-                pass
+    def set_keepalive(self):
+        """Enable TCP keepalive on the control connection
+
+        Stops firewalls from dropping the connection while it is idle
+        """
+
+        sock = self.ftp.sock
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # these options are only available on Linux
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+
+
+    def start_heartbeat(self, interval=45):
+        """Send NOOP every interval seconds from a background thread
+
+        Use while the connection is idle so the server doesn't close it,
+        call stop_heartbeat before sending any other command
+        """
+
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.ftp.voidcmd("NOOP")
+                except all_errors as error:
+                    self.logger.warning("Heartbeat failed: %s", error)
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        self._heartbeat = (stop, thread)
+        thread.start()
+
+
+    def stop_heartbeat(self):
+        """Stop heartbeat, waits for a NOOP in progress to complete"""
+
+        if self._heartbeat is not None:
+            stop, thread = self._heartbeat
+            stop.set()
+            thread.join()
+            self._heartbeat = None
+
+
+    def walk(self, root, skip=None):
+        """Walk remote directory tree starting from root
+
+        Yields (dirPath, filename, facts) for each file found, dirPath
+        is the remote directory path built from root, no cwd is needed.
+        Entries are sorted by name. skip is an optional function called
+        with (dirPath, facts) for each subdirectory, if it returns True
+        the subdirectory is not listed.
+        """
+
+        listing = self.doDirectory(root)
+        for name, facts in sorted(listing.items()):
+            if facts.get("type") == "dir":
+                dirPath = posixpath.join(root, name)
+                if skip is not None and skip(dirPath, facts):
+                    self.logger.debug("Skipping directory: %s", dirPath)
+                    continue
+                yield from self.walk(dirPath, skip=skip)
+            elif facts.get("type") == "file":
+                yield root, name, facts
+
+
+    def doDirectory(self, dirPath):
+        """List remote directory return {name: facts} dictionary
+
+        Uses MLSD so size and modified time for each entry come with
+        the listing, if the server doesn't support it falls back on LIST
+        in unix format which only provides type and size.
+        """
+
+        self.logger.debug("do Directory dirPath: %s", dirPath)
+        if self.has_mlsd():
+            listing = dict(self.ftp.mlsd(dirPath,
+                           facts=["type", "size", "modify"]))
+            self.logger.debug("Dir listing: %s", listing)
+            return listing
+        listing = {}
+
+        def parse_line(line):
+            # split only the first 8 fields so names can contain spaces
+            fields = line.split(None, 8)
+            ftype = {'d': "dir", '-': "file"}.get(line[:1])
+            if ftype is None or len(fields) < 9:
+                return
+            if fields[8] not in [".", ".."]:
+                listing[fields[8]] = {"type": ftype, "size": fields[4]}
+
+        # lines are parsed as they are received, without storing them
+        self.ftp.retrlines(f"LIST {dirPath}", parse_line)
+        self.logger.debug("Dir listing: %s", listing)
+        return listing
+
+
+    def has_mlsd(self):
+        """Check once if server supports MLSD listing using FEAT"""
+
+        if self._mlsd is None:
+            try:
+                self._mlsd = "MLST" in self.ftp.sendcmd("FEAT")
+            except error_perm as error:
+                self.logger.debug("FEAT not supported: %s", error)
+                self._mlsd = False
+        return self._mlsd
+
+
+    def handleFile(self, ftpDir, baseDir, filename, facts):
+        """Handle files, call doFile if extension correspond
+
+        ftpDir and baseDir are the remote and local directories,
+        facts is the dictionary returned for filename by doDirectory
+        """
 
+        if facts.get("type") == "file":
+            if filename.endswith(self.extension):
+               self.doFile(ftpDir, baseDir, filename, facts)
 
-    def doFile(self, baseDir, filename):
-        """Check if file to update or new and call downloadFile"""
 
-        curDir = os.getcwd()
+    def doFile(self, ftpDir, baseDir, filename, facts):
+        """Check if file to update or new and call downloadFile
+
+        Remote and local paths are built from ftpDir and baseDir rather
+        than the current directories, so files can be processed from
+        different threads. Both are expected to be absolute paths
+        """
+
+        remoteFile = posixpath.join(ftpDir, filename)
+        localFile = os.path.join(baseDir, filename)
+        try:
+            st = os.stat(localFile)
+        except FileNotFoundError:
+            st = None
         update = False
         # if files exists and one check method was selected
         # compare to remote to check if to update
-        if(os.path.exists(filename)):
-            if self.check == 'md5sum':
-                update = self.check_md5sum(filename)
-            elif self.check == 'mdate':
-                update = self.check_mdt(filename)
+        if st is not None:
+            if self._check_fn is not None:
+                update = self._check_fn(remoteFile, localFile, facts, st)
             if update is True:
-               self.logger.info(f"file exists to update: {filename}")
+               self.logger.info("file exists to update: %s", filename)
             else:
                 return
         # call download function and add file to list if successful
-        result = self.downloadFile(filename, update)
+        result = self.downloadFile(remoteFile, localFile)
         if result is True:
             if update is True:
-                self.updatedFiles.append(os.path.abspath(filename))
+                self.updatedFiles.append(localFile)
             else:
-                self.newFiles.append(os.path.abspath(filename))
+                self.newFiles.append(localFile)
 
 
-    def check_md5sum(self, filename):
-        """Check local and remote md5 checksum and return comparison
+    def check_md5sum(self, filename, localFile, facts, st):
+        """Check local and remote checksum and return comparison
 
-        This is much slower then checking modified date
+        This is much slower then checking modified date, as the remote
+        file is transferred, so sizes are compared first and the
+        checksum is calculated only if they match.
+        The hash algorithm is set by self.digest (default sha256),
+        st is the os.stat result for localFile
         """
 
-        m = hashlib.md5()
-        self.ftp.retrbinary('RETR %s' % filename, m.update)
-        ftp_md5 =  m.hexdigest()
-        local_md5 = hashlib.md5(open(filename,'rb').read()).hexdigest()
-        self.logger.debug(f"File: {filename}")
-        self.logger.debug(f"Local md5: {local_md5}")
-        self.logger.debug(f"ftp md5: {ftp_md5}")
-        different = local_md5 != ftp_md5
+        local_size = st.st_size
+        if "size" in facts:
+            remote_size = int(facts["size"])
+        else:
+            try:
+                remote_size = self.ftp.size(filename)
+            except error_perm as error:
+                self.logger.debug("Size not available: %s", error)
+                remote_size = local_size
+        if remote_size != local_size:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("File: %s", filename)
+                self.logger.debug("Local size: %s", local_size)
+                self.logger.debug("ftp size: %s", remote_size)
+            return True
+        m = new_hash(self.digest)
+        self.ftp.retrbinary('RETR %s' % filename, m.update,
+                            blocksize=BLOCKSIZE)
+        ftp_sum = m.hexdigest()
+        local_sum = file_checksum(localFile, self.digest)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("File: %s", filename)
+            self.logger.debug("Local %s: %s", self.digest, local_sum)
+            self.logger.debug("ftp %s: %s", self.digest, ftp_sum)
+        different = local_sum != ftp_sum
         return different
 
 
-    def check_mdt(self,filename):
-        """Check local and remote modified time and return comparison"""
+    def check_mdt(self, filename, localFile, facts, st):
+        """Check local and remote modified time and return comparison
 
-        result = self.ftp.sendcmd("MDTM " + filename)
-        remoteLastModDate = datetime(*(strptime(result[4:],
-                                       "%Y%m%d%H%M%S")[0:6]))
-        localModTime = datetime.fromtimestamp(
-                       os.path.getmtime(filename))
+        Remote time is read from the listing facts when available,
+        otherwise it is requested with MDTM, local time from st the
+        os.stat result for localFile
+        """
+
+        if "modify" in facts:
+            remoteTime = facts["modify"]
+        else:
+            remoteTime = self.ftp.sendcmd("MDTM " + filename)[4:]
+        remoteLastModDate = datetime.strptime(remoteTime[:14],
+                                              "%Y%m%d%H%M%S")
+        localModTime = datetime.fromtimestamp(st.st_mtime)
         new = localModTime < remoteLastModDate
-        self.logger.debug(f"File: {filename}")
-        self.logger.debug(f"Local mod_date: {localModTime}")
-        self.logger.debug(f"ftp mod_date: {remoteLastModDate}")
-        self.logger.debug(f"update: {new}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("File: %s", filename)
+            self.logger.debug("Local mod_date: %s", localModTime)
+            self.logger.debug("ftp mod_date: %s", remoteLastModDate)
+            self.logger.debug("update: %s", new)
         return new
 
 
-    def downloadFile(self, filename, isUpdate):
-        """Download file
+    def downloadFile(self, filename, localFile):
+        """Download remote filename to localFile
 
-        If isUpdate is True save it to filename.1
+        File is saved first to localFile.part and moved to localFile
+        only if the download was successful, so an existing file is
+        never replaced by a partial one. Connection errors are raised
+        after removing the partial file
         """
 
-        if isUpdate:
-            newFile = open(filename+".1", "wb")
-        else:
-            newFile = open(filename, "wb")
+        tmpFile = f"{localFile}.part"
         try:
+            self.logger.info("Trying to download file... %s", filename)
+            with open(tmpFile, "wb", buffering=BLOCKSIZE) as newFile:
+                self.ftp.retrbinary(f"RETR {filename}", newFile.write,
+                                    blocksize=BLOCKSIZE)
+                self.set_permissions(newFile.fileno())
+                newFile.flush()
+                os.fsync(newFile.fileno())
+            os.replace(tmpFile, localFile)
+        except CONNECTION_ERRORS:
+            # let the caller decide if to retry with a new connection
             try:
-                self.logger.info(f"Trying to download file... {filename}")
-                self.ftp.retrbinary(f"RETR {filename}", newFile.write)
-                os.popen(f"chmod g+rxX {filename}").readline() 
-                os.popen(f"chgrp ia39 {filename}").readline() 
-            except Exception as e:
-                self.errorFiles.append(f"{filename} could not be downloaded:")
-                self.logger.error(e)
-                return False 
-        finally:
-            newFile.close()
-            if isUpdate:
-               os.rename(f"{filename}.1", filename)
-            return True
+                os.unlink(tmpFile)
+            except FileNotFoundError:
+                pass
+            raise
+        except Exception as e:
+            self.errorFiles.append(f"{filename} could not be downloaded:")
+            self.logger.error(e)
+            try:
+                os.unlink(tmpFile)
+            except FileNotFoundError:
+                pass
+            return False
+        return True
+
+
+    def set_permissions(self, fd):
+        """Give group read and execute permissions to file and set group
+
+        Equivalent to chmod g+rxX and chgrp, fd is the open file descriptor
+        """
+
+        mode = os.fstat(fd).st_mode
+        os.fchmod(fd, mode | stat.S_IRGRP | stat.S_IXGRP)
+        if self._gid is not None:
+            try:
+                os.fchown(fd, -1, self._gid)
+            except OSError as error:
+                self.logger.warning("Could not change group: %s", error)
 
 
     def print_summary(self):
         """Print a summary of new, updated and error files to log file"""
 
-        self.logger.info("==========================================")
-        self.logger.info("Summary")
-        self.logger.info("==========================================")
-        self.logger.info("These files were updated: ")
-        for f in self.updatedFiles:
-            self.logger.info(f"{f}")
-        self.logger.info("==========================================")
-        self.logger.info("These are new files: ")
-        for f in self.newFiles:
-            self.logger.info(f"{f}")
-        self.logger.info("==========================================")
-        self.logger.info("These files and problems: ") 
-        for f in self.errorFiles:
-            self.logger.info(f"{f}")
-        self.logger.info("\n\n") 
+        sep = "=========================================="
+        self.logger.info("\n".join([sep, "Summary", sep]))
+        self.logger.info("\n".join(["These files were updated: "]
+                                   + self.updatedFiles + [sep]))
+        self.logger.info("\n".join(["These are new files: "]
+                                   + self.newFiles + [sep]))
+        self.logger.info("\n".join(["These files and problems: "]
+                                   + self.errorFiles + ["\n\n"]))
 
 
     def close(self):
         """Close ftp connection"""
 
-        self.ftp.quit()
+        self.stop_heartbeat()
+        # the connection might have been dropped while idle
+        try:
+            self.ftp.quit()
+        except all_errors as error:
+            self.logger.debug("Error closing connection: %s", error)
+            self.ftp.close()
+        self.stop_log()
+
+
+    def stop_log(self):
+        """Stop log listener after writing queued records
+
+        Only the instance which set up the logger has a listener
+        """
+
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            for handler in self._handlers:
+                handler.close()
+
+
+def new_hash(digest):
+    """Return a new hash object for digest algorithm name
+
+    blake2b is returned with a 16 bytes digest, same length as md5
+    """
+
+    if digest == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(digest)
+
+
+def file_checksum(fname, digest="sha256"):
+    """Return hexdigest of a local file reading it in blocks
+
+    Avoids loading the whole file in memory, with Python >= 3.11
+    file_digest hashes the file without holding the GIL
+    """
+
+    with open(fname, 'rb') as fh:
+        if hasattr(hashlib, "file_digest"):
+            checksum = hashlib.file_digest(fh, lambda: new_hash(digest))
+            return checksum.hexdigest()
+        m = new_hash(digest)
+        buf = bytearray(BLOCKSIZE)
+        view = memoryview(buf)
+        for size in iter(lambda: fh.readinto(buf), 0):
+            m.update(view[:size])
+    return m.hexdigest()
 
 
 def get_credentials(fname, token=False):